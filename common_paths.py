@@ -1,13 +1,19 @@
 """
-Common path utilities for BlueZones scripts.
+Common path and geometry utilities for BlueZones scripts.
 
 Usage:
 - Set environment variables to point to your data folders or override individual file paths.
 - Defaults fall back to a conventional relative layout under the project root.
+- The reprojected atomic polygons are cached as GeoParquet under <base_dir>/.cache; delete it to force a rebuild.
 
 Environment variables (optional):
   BLUEZONES_BASE_DIR          -> base directory for all data (e.g., /data/BlueZones)
   BLUEZONES_OUTPUT_DIR        -> output directory for CSVs and shapefiles
+  BZ_WRITE_CSV                -> set to 1 to also write the final union table as CSV (Parquet is always written)
+  BZ_WRITE_QA                 -> set to 1 to also write per-layer intersection layers to shapefiles/qa.gpkg
+  BZ_WRITE_QA_CSV             -> set to 1 to also write per-layer dissolved CSVs for QA
+  BZ_BACKEND                  -> set to "dask" to find overlay candidates with dask-geopandas
+                                 (optional dependency; only pays off for ~1M+ atomic polygons)
 
 Per-file overrides (optional):
   ATOMIC_POLYGONS_PATH
@@ -29,11 +35,23 @@ Per-file overrides (optional):
   PAST_INTSTREAM_PATH
 """
 from __future__ import annotations
+import functools
+import hashlib
 import os
+from collections import Counter
 from pathlib import Path
 
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import pyproj
+import shapely
 
+
+@functools.lru_cache(maxsize=1)
 def base_dir() -> Path:
+    # Resolved once per process; the environment is not expected to change mid-run
     return Path(os.getenv("BLUEZONES_BASE_DIR", ".")).resolve()
 
 
@@ -54,9 +72,239 @@ def shapefile_subdir(parent: Path) -> Path:
     return shp
 
 
-def path_from_env(var: str, relative_default: str) -> Path:
-    # If env var provided, use it; else join base_dir with relative_default
+def path_from_env(var: str, relative_default: str, root: Path | None = None) -> Path:
+    # If env var provided, use it; else join root (default: base_dir) with relative_default
     p = os.getenv(var)
     if p:
         return Path(p)
-    return base_dir() / relative_default
+    root = root if root is not None else base_dir()
+    return root / relative_default
+
+
+def env_flag(var: str) -> bool:
+    # Opt-in switches: only "1" enables
+    return os.getenv(var, "0") == "1"
+
+
+def read_layer(path: Path, columns: list[str] | None = None, bbox: tuple | None = None, **kwargs):
+    # pyogrio reads through the GDAL C API and pushes the column and bbox filters down into GDAL
+    return gpd.read_file(path, engine="pyogrio", columns=columns, bbox=bbox, **kwargs)
+
+
+def layer_bbox(path: Path, bounds, crs: pyproj.CRS) -> tuple:
+    """Re-express `bounds` (minx, miny, maxx, maxy in `crs`) in the native CRS of the layer at `path`.
+
+    Used to clip read_layer() to the atomic polygons without reprojecting the whole layer first.
+    """
+    layer_crs = pyogrio.read_info(path)["crs"]
+    if layer_crs is None or pyproj.CRS(layer_crs).equals(crs):
+        return tuple(bounds)
+    transformer = pyproj.Transformer.from_crs(crs, layer_crs, always_xy=True)
+    return tuple(transformer.transform_bounds(*bounds))
+
+
+def to_crs_if_needed(gdf: gpd.GeoDataFrame, crs: pyproj.CRS) -> gpd.GeoDataFrame:
+    # Layers already in the target CRS are returned as-is instead of being reprojected
+    return gdf if gdf.crs is not None and gdf.crs.equals(crs) else gdf.to_crs(crs)
+
+
+def _source_mtime(source: Path) -> float:
+    # Newest of the shapefile parts; attribute-only edits touch just the .dbf
+    parts = [source.with_suffix(ext) for ext in (".shp", ".dbf", ".shx", ".prj")]
+    return max(p.stat().st_mtime for p in parts + [source] if p.exists())
+
+
+def atomic_cache(source: Path, desired_crs: pyproj.CRS) -> Path:
+    """Path to a GeoParquet copy of the atomic polygons, reprojected and with `area` precomputed.
+
+    The cache lives under <base_dir>/.cache, keyed on the resolved source path, and is rebuilt
+    whenever any part of the source shapefile is newer.
+    """
+    source = Path(source).resolve()
+    key = hashlib.sha1(str(source).encode()).hexdigest()[:12]
+    cache = base_dir() / ".cache" / f"{source.stem}_{key}_{desired_crs.to_epsg()}.parquet"
+    if not cache.exists() or cache.stat().st_mtime < _source_mtime(source):
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        gdf = to_crs_if_needed(gpd.read_file(source), desired_crs)
+        gdf['area'] = gdf.geometry.area
+        # Write beside the cache and swap it in, so concurrent runs never read a partial file
+        tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+        try:
+            gdf.to_parquet(tmp)
+            os.replace(tmp, cache)
+        finally:
+            tmp.unlink(missing_ok=True)
+    return cache
+
+
+def read_atomic(cache: Path, columns: list[str] | None = None) -> pd.DataFrame:
+    # Without 'geometry' in `columns` this is a plain attribute read that never decodes WKB.
+    # unique_id is categorical so the per-layer groupbys hash small integer codes, not raw ids
+    if columns is not None and 'geometry' not in columns:
+        df = pd.read_parquet(cache, columns=columns)
+    else:
+        df = gpd.read_parquet(cache, columns=columns)
+    df['unique_id'] = df['unique_id'].astype('category')
+    return df
+
+
+def load_atomic(source: Path, desired_crs: pyproj.CRS, columns: list[str] | None = None) -> pd.DataFrame:
+    # Atomic polygons in desired_crs with an `area` column, via the parquet cache
+    return read_atomic(atomic_cache(source, desired_crs), columns=columns)
+
+
+def concat_layer_tables(frames: dict) -> tuple[pd.DataFrame, dict]:
+    """Outer-join per-layer tables indexed by unique_id into one wide table, in a single concat.
+
+    `frames` maps layer name -> table. A column that appears in more than one table is
+    prefixed with its layer name (``<layer>_<column>``), so the result has unique columns.
+    Returns (table, renames) where renames[layer] maps each renamed column to its new name.
+    """
+    counts = Counter(c for frame in frames.values() for c in frame.columns)
+    renames = {
+        name: {c: f"{name}_{c}" for c in frame.columns if counts[c] > 1}
+        for name, frame in frames.items()
+    }
+    renamed = [frame.rename(columns=renames[name]) for name, frame in frames.items()]
+    return pd.concat(renamed, axis=1, join='outer'), renames
+
+
+def _polygonal(geoms: np.ndarray) -> np.ndarray:
+    # Keep only the polygonal parts of mixed intersection results (edges/corners that merely
+    # touch), mirroring gpd.overlay(..., keep_geom_type=True)
+    mixed = np.flatnonzero(shapely.get_type_id(geoms) == shapely.GeometryType.GEOMETRYCOLLECTION)
+    for i in mixed:
+        parts = shapely.get_parts(geoms[i])
+        geoms[i] = shapely.union_all(parts[shapely.area(parts) > 0])
+    return geoms
+
+
+def _dask_candidate_pairs(left: gpd.GeoDataFrame, right: gpd.GeoDataFrame):
+    # Same pairs as the sindex query, with the join spread over spatially shuffled partitions.
+    # Both sides carry spatial partitions, so only partition pairs whose bounds meet are joined.
+    # The id scripts default to one layer worker under this backend to avoid oversubscription.
+    import dask_geopandas as dgpd
+
+    nparts = os.cpu_count() or 1
+    left_pos = gpd.GeoDataFrame({"_left": np.arange(len(left))}, geometry=np.asarray(left.geometry.values), crs=left.crs)
+    right_pos = gpd.GeoDataFrame({"_right": np.arange(len(right))}, geometry=np.asarray(right.geometry.values), crs=right.crs)
+    a = dgpd.from_geopandas(left_pos, npartitions=nparts).spatial_shuffle(by="hilbert", level=10)
+    b = dgpd.from_geopandas(right_pos, npartitions=nparts).spatial_shuffle(by="hilbert", level=10)
+    pairs = a.sjoin(b, predicate="intersects").compute()
+
+    left_idx = pairs["_left"].to_numpy()
+    right_idx = pairs["_right"].to_numpy()
+    # Restore the sindex.query ordering (by right, then left) so "first" aggregations match
+    order = np.lexsort((left_idx, right_idx))
+    return left_idx[order], right_idx[order]
+
+
+def _candidate_pairs(left: gpd.GeoDataFrame, right: gpd.GeoDataFrame):
+    if os.getenv("BZ_BACKEND") == "dask":
+        return _dask_candidate_pairs(left, right)
+    right_idx, left_idx = left.sindex.query(right.geometry, predicate="intersects")
+    return left_idx, right_idx
+
+
+def _intersect_candidates(left: gpd.GeoDataFrame, right: gpd.GeoDataFrame):
+    # Candidate (left, right) pairs from one bulk query against the spatial index of `left`,
+    # intersected in a single vectorized call. Where the left geometry fully contains its right
+    # partner the right geometry is reused as-is instead of intersected; that test is much cheaper
+    # when `left` has been passed through shapely.prepare() beforehand.
+    left_idx, right_idx = _candidate_pairs(left, right)
+    left_geoms = np.asarray(left.geometry.values)[left_idx]
+    right_geoms = np.asarray(right.geometry.values)[right_idx]
+
+    geoms = right_geoms.copy()
+    todo = ~shapely.contains(left_geoms, right_geoms)
+    geoms[todo] = shapely.intersection(left_geoms[todo], right_geoms[todo])
+    return left_idx, right_idx, geoms
+
+
+def fast_intersection(left: gpd.GeoDataFrame, right: gpd.GeoDataFrame, pairs: tuple | None = None) -> gpd.GeoDataFrame:
+    """Polygon intersection of two layers; drop-in for gpd.overlay(left, right, how='intersection').
+
+    `pairs` is an optional (left_idx, right_idx, geoms) already computed for the same two
+    layers (see overlap_pairs), so the intersections are not run through GEOS a second time.
+    """
+    left_idx, right_idx, geoms = pairs if pairs is not None else _intersect_candidates(left, right)
+    geoms = _polygonal(geoms.copy())
+
+    keep = shapely.area(geoms) > 0
+    left_idx, right_idx, geoms = left_idx[keep], right_idx[keep], geoms[keep]
+
+    # Attribute columns of both sides, suffixed like overlay on name collisions
+    left_attrs = left.drop(columns=left.geometry.name).iloc[left_idx].reset_index(drop=True)
+    right_attrs = right.drop(columns=right.geometry.name).iloc[right_idx].reset_index(drop=True)
+    common = left_attrs.columns.intersection(right_attrs.columns)
+    left_attrs = left_attrs.rename(columns={c: f"{c}_1" for c in common})
+    right_attrs = right_attrs.rename(columns={c: f"{c}_2" for c in common})
+    attrs = pd.concat([left_attrs, right_attrs], axis=1)
+    return gpd.GeoDataFrame(attrs, geometry=geoms, crs=left.crs)
+
+
+def subdivide(gdf: gpd.GeoDataFrame, max_vertices: int = 256) -> gpd.GeoDataFrame:
+    """Cut polygons with more than `max_vertices` coordinates into grid tiles, like PostGIS ST_Subdivide.
+
+    Each oversized feature is clipped to a square grid over its bounding box sized to leave
+    roughly `max_vertices` coordinates per tile. Tiles do not overlap, so area sums per source
+    feature are unchanged; attributes are copied onto every piece. Pieces keep the row order of
+    their source features, so 'first' aggregations downstream pick the same values.
+    """
+    geoms = np.asarray(gdf.geometry.values)
+    ncoords = shapely.get_num_coordinates(geoms)
+    big = np.flatnonzero(ncoords > max_vertices)
+    if big.size == 0:
+        return gdf
+
+    src = [np.flatnonzero(ncoords <= max_vertices)]
+    out = [geoms[src[0]]]
+    for i in big:
+        side = int(np.ceil(np.sqrt(ncoords[i] / max_vertices)))
+        xmin, ymin, xmax, ymax = shapely.bounds(geoms[i])
+        xs, ys = np.linspace(xmin, xmax, side + 1), np.linspace(ymin, ymax, side + 1)
+        x0, y0 = np.meshgrid(xs[:-1], ys[:-1])
+        x1, y1 = np.meshgrid(xs[1:], ys[1:])
+        tiles = shapely.box(x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel())
+        pieces = _polygonal(shapely.intersection(geoms[i], tiles))
+        pieces = pieces[shapely.area(pieces) > 0]
+        src.append(np.full(len(pieces), i))
+        out.append(pieces)
+
+    # Put each feature's tiles back where the feature was
+    src = np.concatenate(src)
+    order = np.argsort(src, kind="stable")
+    src = src[order]
+    attrs = gdf.drop(columns=gdf.geometry.name).iloc[src].reset_index(drop=True)
+    return gpd.GeoDataFrame(attrs, geometry=np.concatenate(out)[order], crs=gdf.crs)
+
+
+def overlap_pairs(left: gpd.GeoDataFrame, right: gpd.GeoDataFrame):
+    """Every overlapping (left, right) pair, without building an intersection GeoDataFrame.
+
+    Returns (left_idx, right_idx, geoms, areas) as NumPy arrays of positional indices,
+    intersection geometries and areas in CRS units; pairs that only touch (zero area) are
+    dropped. Pass the first three to fast_intersection(pairs=...) to reuse the geometries.
+    """
+    left_idx, right_idx, geoms = _intersect_candidates(left, right)
+    areas = shapely.area(geoms)
+    keep = areas > 0
+    return left_idx[keep], right_idx[keep], geoms[keep], areas[keep]
+
+
+def fast_dissolve(gdf: gpd.GeoDataFrame, by: str, aggfunc: dict) -> gpd.GeoDataFrame:
+    """Union geometries per `by` group; drop-in for gdf.dissolve(by=by, aggfunc=aggfunc, as_index=False).
+
+    Geometries are sorted by group code once and each contiguous slice is unioned directly,
+    instead of dissolve building a small GeoDataFrame per group.
+    """
+    codes, _ = pd.factorize(gdf[by], sort=True)
+    order = np.argsort(codes, kind="stable")
+    geoms = np.asarray(gdf.geometry.values)[order]
+    starts = np.unique(codes[order], return_index=True)[1]
+    unions = [shapely.union_all(group) for group in np.split(geoms, starts[1:])]
+
+    # groupby(sort=True) orders groups like factorize(sort=True), so rows line up with `unions`
+    attrs = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    attrs = attrs.groupby(by, sort=True, observed=True).agg(aggfunc).reset_index()
+    return gpd.GeoDataFrame(attrs, geometry=unions, crs=gdf.crs)
@@ -4,20 +4,26 @@ Blue Zone Analysis — FUTURE (intersections, merges, and spatial join)
 Purpose
 -------
 Load processed FUTURE flood layers, intersect with masked atomic polygons, aggregate by unique_id,
-and export dissolved CSVs and a final union CSV.
+and export a final union table (Parquet; CSV optional).
 
 Path Configuration
 ------------------
 All paths are configurable via environment variables (see common_paths.py). Sensible project-relative
 defaults are provided so the script can run out-of-the-box with a conventional layout.
 """
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 import pyproj
+import shapely
 
-from common_paths import path_from_env, output_dir, shapefile_subdir
+from common_paths import (path_from_env, output_dir, shapefile_subdir, env_flag, atomic_cache, read_atomic, load_atomic,
+                          read_layer, layer_bbox, subdivide, fast_intersection, overlap_pairs,
+                          concat_layer_tables, to_crs_if_needed)
 
 # --- Input paths (override via env vars if needed) ---
 atomic_polygons_path = path_from_env("ATOMIC_POLYGONS_PATH", "Mask/atomic_regular_State.shp")
@@ -25,94 +31,146 @@ future_mod_2050_path = path_from_env("FUTURE_MOD_2050_PATH", "future_flooding/Mo
 future_ext_2080_path = path_from_env("FUTURE_EXT_2080_PATH", "future_flooding/Extreme_2080_Flood_poly.shp")
 future_500yr_path    = path_from_env("FUTURE_500YR_PATH",    "future_flooding/500yr.shp")
 
-# --- Outputs ---
-output_directory = output_dir("output_csv/future")
-output_directory_shp = shapefile_subdir(output_directory)
-
-# --- Load data ---
-atomic_polygons = gpd.read_file(atomic_polygons_path)
-future_moderate_2050_flood = gpd.read_file(future_mod_2050_path)
-future_extreme_2080_flood  = gpd.read_file(future_ext_2080_path)
-future_500yr               = gpd.read_file(future_500yr_path)
-print('Future layers loaded')
-
 desired_crs = pyproj.CRS.from_epsg(2263)
-atomic_polygons = atomic_polygons.to_crs(desired_crs)
-atomic_polygons['area'] = atomic_polygons.geometry.area
-
-intersection_dict = {}
-new_field_names = []
-dissolved_csv_filenames = []
 
 shapefiles_future = [
-    {'gdf': future_moderate_2050_flood, 'flag_field': 'mod_2050', 'flood_type': 'mo_20_fldC'},
-    {'gdf': future_extreme_2080_flood,  'flag_field': 'ext_2080', 'flood_type': 'ex_20_fldC'},
-    {'gdf': future_500yr,               'flag_field': '500yr'},
+    {'path': future_mod_2050_path, 'flag_field': 'mod_2050', 'flood_type': 'mo_20_fldC'},
+    {'path': future_ext_2080_path, 'flag_field': 'ext_2080', 'flood_type': 'ex_20_fldC'},
+    {'path': future_500yr_path,    'flag_field': '500yr'},
 ]
-print('Future shapefile list created')
 
-count = 0
-for shapefile_future in shapefiles_future:
-    gdf = shapefile_future['gdf'].to_crs(desired_crs)
-    intersection_result = gpd.overlay(atomic_polygons, gdf, how='intersection')
+
+def process_layer(atomic_path: Path, shapefile_future: dict, output_directory: Path):
+    """Intersect one future layer with the atomic polygons and aggregate by unique_id.
+
+    Runs in a worker process, so inputs are read from disk rather than pickled over.
+    Returns (area field name, dissolved table indexed by unique_id, QA layer or None).
+    """
+    # Carry only the columns the aggregation needs through the intersection
+    keep_fields = [shapefile_future['flag_field']]
+    if 'flood_type' in shapefile_future:
+        keep_fields.append(shapefile_future['flood_type'])
+    atomic_min = read_atomic(atomic_path, columns=['unique_id', 'area', 'geometry'])
+    # Prepared once, the atomic polygons answer every contains/intersects test below faster
+    shapely.prepare(atomic_min.geometry.values)
+    # Read only the kept columns, and only features near the atomic polygons
+    bbox = layer_bbox(shapefile_future['path'], atomic_min.total_bounds, desired_crs)
+    gdf = read_layer(shapefile_future['path'], columns=keep_fields, bbox=bbox)
+    gdf = to_crs_if_needed(gdf, desired_crs)
+    # Very detailed polygons (FEMA zones, marine waters, ...) are tiled so each intersection stays small
+    if len(gdf) and shapely.get_num_coordinates(gdf.geometry.values).max() > 1000:
+        gdf = subdivide(gdf)
 
     new_field_name = shapefile_future['flag_field'][:-2] + 'A'
-    new_field_names.append(new_field_name)
 
+    # Only the per-pair overlap area is needed, so aggregate it directly by unique_id
     # area in feet (assuming CRS in feet; EPSG:2263 is US ft)
-    intersection_result[new_field_name] = intersection_result['geometry'].area
-
-    # Save intermediate (not dissolved) shapefile for QA
-    shp_filename = output_directory_shp / f"{shapefile_future['flag_field']}_notdissolved.shp"
-    intersection_result.to_file(shp_filename)
-
-    # Export per-layer dissolved CSV
-    df = pd.DataFrame(intersection_result)
-    if count <= 1 and 'flood_type' in shapefile_future:
-        dissolved_df = df.groupby('unique_id').agg({
-            new_field_name: 'sum',
-            shapefile_future['flag_field']: 'first',
-            shapefile_future['flood_type']: 'first'
-        }).reset_index()
+    left_idx, right_idx, geoms, areas = overlap_pairs(atomic_min, gdf)
+    df = pd.DataFrame({'unique_id': atomic_min['unique_id'].values[left_idx], new_field_name: areas})
+    for field in keep_fields:
+        df[field] = gdf[field].values[right_idx]
+    dissolved_df = df.groupby('unique_id', sort=False, observed=True).agg(
+        {new_field_name: 'sum', **{field: 'first' for field in keep_fields}}
+    ).reset_index()
+
+    # Optional: intermediate (not dissolved) intersection layer for QA
+    qa_layer = None
+    if env_flag('BZ_WRITE_QA'):
+        # Reuses the intersections computed above; rows line up with `areas`
+        intersection_result = fast_intersection(atomic_min, gdf, pairs=(left_idx, right_idx, geoms))
+        intersection_result[new_field_name] = areas
+        qa_layer = intersection_result
+
+    # Optional: export per-layer dissolved CSV
+    if env_flag('BZ_WRITE_QA_CSV'):
+        csv_filename = output_directory / f"{shapefile_future['flag_field']}_dissolved.csv"
+        dissolved_df.to_csv(csv_filename, index=False)
+        print(f"Exported {csv_filename.name}")
+    print(f"Processed {shapefile_future['flag_field']}")
+    return new_field_name, dissolved_df.set_index('unique_id'), qa_layer
+
+
+def build_final(dissolved_frames: dict, new_field_names: dict, atomic_poly_csv: pd.DataFrame) -> pd.DataFrame:
+    """Join the per-layer tables onto the atomic polygons and add the *fg and BZ_future flags."""
+    final_df, renames = concat_layer_tables(dissolved_frames)
+    # Area columns under their joined names; only names shared by two layers were prefixed
+    area_fields = [renames[layer].get(name, name) for layer, name in new_field_names.items()]
+
+    # Join atomic polygon area
+    final_df = atomic_poly_csv.set_index('unique_id').join(
+        final_df, how='left', lsuffix='_x', rsuffix='_y'
+    ).reset_index()
+
+    # Flag thresholds per layer and compute BZ_future
+    # One 2-D comparison of every area column against its row threshold. float64 is kept
+    # so areas sitting right at 10% are not flipped by float32 rounding
+    layer_areas = final_df[area_fields].to_numpy(dtype=np.float64)
+    threshold = 0.10 * final_df['area'].to_numpy(dtype=np.float64)
+    flags = np.greater_equal(layer_areas, threshold[:, None], out=np.empty(layer_areas.shape, dtype=bool))
+    flag_df = pd.DataFrame(flags.astype(np.int8), columns=[n + 'fg' for n in area_fields], index=final_df.index)
+    final_df = pd.concat([final_df, flag_df], axis=1)
+
+    # Reduce the same boolean array rather than re-reading the flag columns
+    final_df['BZ_future'] = flags.any(axis=1).astype(np.int8)
+    return final_df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Intersect FUTURE flood layers with the atomic polygons.")
+    parser.add_argument("--atomic", type=Path, default=atomic_polygons_path,
+                        help="atomic polygons shapefile (default: ATOMIC_POLYGONS_PATH or project layout)")
+    parser.add_argument("--output-dir", type=Path, default=None,
+                        help="output directory (default: BLUEZONES_OUTPUT_DIR or output_csv/future)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per layer, capped at the CPU count; 1 with BZ_BACKEND=dask)")
+    args = parser.parse_args(argv)
+
+    # --- Outputs ---
+    if args.output_dir is not None:
+        output_directory = args.output_dir
+        output_directory.mkdir(parents=True, exist_ok=True)
+    else:
+        output_directory = output_dir("output_csv/future")
+    output_directory_shp = shapefile_subdir(output_directory)
+
+    # Build the atomic cache up front so workers only ever read it
+    atomic_path = atomic_cache(args.atomic, desired_crs)
+
+    # --- Intersect each layer in its own process ---
+    # The dask backend already spreads each layer's join over every core, so layers run one at a time
+    if os.getenv("BZ_BACKEND") == "dask":
+        default_workers = 1
     else:
-        dissolved_df = df.groupby('unique_id').agg({
-            new_field_name: 'sum',
-            shapefile_future['flag_field']: 'first'
-        }).reset_index()
-    count += 1
-
-    csv_filename = output_directory / f"{shapefile_future['flag_field']}_dissolved.csv"
-    dissolved_df.to_csv(csv_filename, index=False)
-    dissolved_csv_filenames.append(csv_filename)
-    print(f"Exported {csv_filename.name}")
-
-# Merge dissolved CSVs on unique_id
-print(new_field_names)
-
-dataframes = [pd.read_csv(p) for p in dissolved_csv_filenames]
-final_df = dataframes[0]
-suffix_counter = 0
-for df in dataframes[1:]:
-    suffix_counter += 1
-    suffix = f"_{suffix_counter}"
-    final_df = final_df.merge(df, on='unique_id', how='outer', suffixes=(suffix, suffix))
-
-# Join atomic polygon area
-atomic_poly_csv = pd.DataFrame(atomic_polygons)
-final_df = atomic_poly_csv.merge(final_df, on='unique_id', how='left', suffixes=('_x', '_y'))
-
-# Flag thresholds per layer and compute BZ_future
-for n in new_field_names:
-    threshold = 0.10 * final_df['area']
-    new_flag = n + 'fg'
-    final_df[new_flag] = (final_df[n] >= threshold).astype(int)
-
-final_df['BZ_future'] = 0
-final_df.loc[
-    (final_df.get('mod_20Afg', 0) == 1) |
-    (final_df.get('ext_20Afg', 0) == 1) |
-    (final_df.get('500Afg',   0) == 1), 'BZ_future'] = 1
-
-final_output_csv = output_directory / 'future_union.csv'
-final_df.to_csv(final_output_csv, index=False, header=True)
-print(f"Final CSV saved: {final_output_csv}")
+        default_workers = min(len(shapefiles_future), os.cpu_count() or 1)
+    workers = args.workers or default_workers
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(process_layer, repeat(atomic_path), shapefiles_future, repeat(output_directory)))
+    new_field_names = {spec['flag_field']: name for spec, (name, _, _) in zip(shapefiles_future, results)}
+    dissolved_frames = {spec['flag_field']: frame for spec, (_, frame, _) in zip(shapefiles_future, results)}
+
+    # QA layers are written here, one transaction per layer, so workers never share the GeoPackage
+    for shapefile_future, (_, _, qa_layer) in zip(shapefiles_future, results):
+        if qa_layer is not None:
+            qa_layer.to_file(output_directory_shp / 'qa.gpkg', layer=f"{shapefile_future['flag_field']}_notdissolved",
+                             driver='GPKG', engine='pyogrio')
+
+    # Join dissolved tables on unique_id
+    print(list(new_field_names.values()))
+
+    # Only unique_id and area are carried into the output; atomic geometry stays on disk
+    atomic_poly_csv = load_atomic(args.atomic, desired_crs, columns=['unique_id', 'area'])
+    final_df = build_final(dissolved_frames, new_field_names, atomic_poly_csv)
+
+    # Parquet is the primary output
+    final_output = output_directory / 'future_union.parquet'
+    final_df.to_parquet(final_output, engine='pyarrow', compression='zstd', index=False)
+    print(f"Final table saved: {final_output}")
+
+    if env_flag('BZ_WRITE_CSV'):
+        final_output_csv = output_directory / 'future_union.csv'
+        final_df.to_csv(final_output_csv, index=False, header=True)
+        print(f"Final CSV saved: {final_output_csv}")
+
+
+if __name__ == "__main__":
+    main()
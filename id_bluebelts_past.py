@@ -4,20 +4,26 @@ Blue Zone Analysis — PAST (intersections, merges, and spatial join)
 Purpose
 -------
 Load PAST (Welikia) historical ecology layers, intersect with masked atomic polygons, aggregate by
-unique_id, and export dissolved CSVs and a final union CSV.
+unique_id, and export a final union table (Parquet; CSV optional).
 
 Path Configuration
 ------------------
 All paths are configurable via environment variables (see common_paths.py). Sensible project-relative
 defaults are provided so the script can run with a conventional layout.
 """
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 import pyproj
+import shapely
 
-from common_paths import path_from_env, output_dir, shapefile_subdir
+from common_paths import (path_from_env, output_dir, shapefile_subdir, env_flag, atomic_cache, read_atomic, load_atomic,
+                          read_layer, layer_bbox, subdivide, fast_intersection, fast_dissolve, overlap_pairs,
+                          concat_layer_tables, to_crs_if_needed)
 
 # --- Input paths ---
 atomic_polygons_path   = path_from_env("ATOMIC_POLYGONS_PATH",   "Mask/atomic_regular_State.shp")
@@ -32,90 +38,146 @@ past_dunes_path        = path_from_env("PAST_DUNES_PATH",        "historical/dun
 past_tidalcreek_path   = path_from_env("PAST_TIDALCREEK_PATH",   "historical/tidal_creek.shp")
 past_intstream_path    = path_from_env("PAST_INTSTREAM_PATH",    "historical/int_stream.shp")
 
-# --- Outputs ---
-output_directory = output_dir("output_csv/past")
-output_directory_shp = shapefile_subdir(output_directory)
-
-# --- Load data ---
-atomic_polygons = gpd.read_file(atomic_polygons_path)
-past_beaches = gpd.read_file(past_beaches_path)
-past_freshwater_river = gpd.read_file(past_river_path)
-past_freshwater_wetlands = gpd.read_file(past_freshwetl_path)
-past_marine_water = gpd.read_file(past_marine_path)
-past_pond = gpd.read_file(past_pond_path)
-past_saltmarsh = gpd.read_file(past_saltmarsh_path)
-past_streams_buffer15 = gpd.read_file(past_streams_path)
-past_dune = gpd.read_file(past_dunes_path)
-past_tidal_creek = gpd.read_file(past_tidalcreek_path)
-past_intermit = gpd.read_file(past_intstream_path)
-print('Past layers loaded')
-
 desired_crs = pyproj.CRS.from_epsg(2263)
-atomic_polygons = atomic_polygons.to_crs(desired_crs)
-atomic_polygons['area'] = atomic_polygons.geometry.area
-
-new_field_names = []
-dissolved_csv_filenames = []
 
 shapefiles_past = [
-    {'gdf': past_beaches,               'flag_field': 'beaches'},
-    {'gdf': past_freshwater_river,      'flag_field': 'river'},
-    {'gdf': past_freshwater_wetlands,   'flag_field': 'fresh_wetl'},
-    {'gdf': past_marine_water,          'flag_field': 'marine'},
-    {'gdf': past_pond,                  'flag_field': 'pond'},
-    {'gdf': past_saltmarsh,             'flag_field': 'saltmarsh'},
-    {'gdf': past_streams_buffer15,      'flag_field': 'streams'},
-    {'gdf': past_dune,                  'flag_field': 'dunes'},
-    {'gdf': past_tidal_creek,           'flag_field': 'tidal_cree'},
-    {'gdf': past_intermit,              'flag_field': 'int_stream'},
+    {'path': past_beaches_path,     'flag_field': 'beaches'},
+    {'path': past_river_path,       'flag_field': 'river'},
+    {'path': past_freshwetl_path,   'flag_field': 'fresh_wetl'},
+    {'path': past_marine_path,      'flag_field': 'marine'},
+    {'path': past_pond_path,        'flag_field': 'pond'},
+    {'path': past_saltmarsh_path,   'flag_field': 'saltmarsh'},
+    {'path': past_streams_path,     'flag_field': 'streams'},
+    {'path': past_dunes_path,       'flag_field': 'dunes'},
+    {'path': past_tidalcreek_path,  'flag_field': 'tidal_cree'},
+    {'path': past_intstream_path,   'flag_field': 'int_stream'},
 ]
-print('Past shapefile list created')
 
-for shapefile_past in shapefiles_past:
-    gdf = shapefile_past['gdf'].to_crs(desired_crs)
-    intersection_result = gpd.overlay(atomic_polygons, gdf, how='intersection')
 
-    new_field_name = shapefile_past['flag_field'][:-2] + 'A'
-    new_field_names.append(new_field_name)
+def process_layer(atomic_path: Path, shapefile_past: dict, output_directory: Path):
+    """Intersect one past layer with the atomic polygons and aggregate by unique_id.
+
+    Runs in a worker process, so inputs are read from disk rather than pickled over.
+    Returns (area field name, dissolved table indexed by unique_id, QA layer or None).
+    """
+    # Carry only the columns the aggregation needs through the intersection
+    atomic_min = read_atomic(atomic_path, columns=['unique_id', 'area', 'geometry'])
+    # Prepared once, the atomic polygons answer every contains/intersects test below faster
+    shapely.prepare(atomic_min.geometry.values)
+    # Read only the flag column, and only features near the atomic polygons
+    bbox = layer_bbox(shapefile_past['path'], atomic_min.total_bounds, desired_crs)
+    gdf = read_layer(shapefile_past['path'], columns=[shapefile_past['flag_field']], bbox=bbox)
+    gdf = to_crs_if_needed(gdf, desired_crs)
+    # Long Welikia shorelines (marine waters, salt marsh, buffered streams) are tiled so each intersection stays small
+    if len(gdf) and shapely.get_num_coordinates(gdf.geometry.values).max() > 1000:
+        gdf = subdivide(gdf)
 
-    intersection_result[new_field_name] = intersection_result['geometry'].area
-
-    # Optional: write dissolved SHP for QA
-    dissolved_gdf = intersection_result.dissolve(by='unique_id', aggfunc={new_field_name: 'sum', shapefile_past['flag_field']:'first'}, as_index=False)
-    shp_filename = output_directory_shp / f"{shapefile_past['flag_field']}_dissolved.shp"
-    dissolved_gdf.to_file(shp_filename)
+    new_field_name = shapefile_past['flag_field'][:-2] + 'A'
 
-    # Export per-layer dissolved CSV
-    df = pd.DataFrame(intersection_result)
-    dissolved_df = df.groupby('unique_id').agg({
+    # Only the per-pair overlap area is needed, so aggregate it directly by unique_id
+    left_idx, right_idx, geoms, areas = overlap_pairs(atomic_min, gdf)
+    df = pd.DataFrame({
+        'unique_id': atomic_min['unique_id'].values[left_idx],
+        new_field_name: areas,
+        shapefile_past['flag_field']: gdf[shapefile_past['flag_field']].values[right_idx],
+    })
+    dissolved_df = df.groupby('unique_id', sort=False, observed=True).agg({
         new_field_name: 'sum',
         shapefile_past['flag_field']:'first'
     }).reset_index()
 
-    csv_filename = output_directory / f"{shapefile_past['flag_field']}_dissolved.csv"
-    dissolved_df.to_csv(csv_filename, index=False)
-    dissolved_csv_filenames.append(csv_filename)
-    print(f"Exported {csv_filename.name}")
-
-# Merge dissolved CSVs on unique_id
-print(new_field_names)
-
-dataframes = [pd.read_csv(p) for p in dissolved_csv_filenames]
-final_df = dataframes[0]
-suffix_counter = 0
-for df in dataframes[1:]:
-    suffix_counter += 1
-    suffix = f"_{suffix_counter}"
-    final_df = final_df.merge(df, on='unique_id', how='outer', suffixes=(suffix, suffix))
-
-# Compute past_sum, join area, then BZ_past
-atomic_poly_csv = pd.DataFrame(atomic_polygons)
-final_df['past_sum'] = final_df[new_field_names].sum(axis=1)
-final_df = atomic_poly_csv.merge(final_df, on='unique_id', how='left', suffixes=('_x', '_y'))
-
-threshold = 0.10 * final_df['area']
-final_df['BZ_past'] = (final_df['past_sum'] >= threshold).astype(int)
-
-final_output_csv = output_directory / 'past_union.csv'
-final_df.to_csv(final_output_csv, index=False)
-print(f"Final CSV saved: {final_output_csv}")
+    # Optional: dissolved intersection layer for QA
+    qa_layer = None
+    if env_flag('BZ_WRITE_QA'):
+        # Reuses the intersections computed above; rows line up with `areas`
+        intersection_result = fast_intersection(atomic_min, gdf, pairs=(left_idx, right_idx, geoms))
+        intersection_result[new_field_name] = areas
+        qa_layer = fast_dissolve(intersection_result, 'unique_id', {new_field_name: 'sum', shapefile_past['flag_field']:'first'})
+
+    # Optional: export per-layer dissolved CSV
+    if env_flag('BZ_WRITE_QA_CSV'):
+        csv_filename = output_directory / f"{shapefile_past['flag_field']}_dissolved.csv"
+        dissolved_df.to_csv(csv_filename, index=False)
+        print(f"Exported {csv_filename.name}")
+    print(f"Processed {shapefile_past['flag_field']}")
+    return new_field_name, dissolved_df.set_index('unique_id'), qa_layer
+
+
+def build_final(dissolved_frames: dict, new_field_names: dict, atomic_poly_csv: pd.DataFrame) -> pd.DataFrame:
+    """Join the per-layer tables onto the atomic polygons and add past_sum and BZ_past."""
+    final_df, renames = concat_layer_tables(dissolved_frames)
+    # Area columns under their joined names; only names shared by two layers were prefixed
+    area_fields = [renames[layer].get(name, name) for layer, name in new_field_names.items()]
+
+    # Compute past_sum, join area, then BZ_past
+    final_df['past_sum'] = final_df[area_fields].sum(axis=1)
+    final_df = atomic_poly_csv.set_index('unique_id').join(
+        final_df, how='left', lsuffix='_x', rsuffix='_y'
+    ).reset_index()
+
+    # float64 as in the other eras, so sums right at 10% are not flipped by rounding
+    threshold = 0.10 * final_df['area'].to_numpy(dtype=np.float64)
+    past_sum = final_df['past_sum'].to_numpy(dtype=np.float64)
+    final_df['BZ_past'] = (past_sum >= threshold).astype(np.int8)
+    return final_df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Intersect PAST (Welikia) layers with the atomic polygons.")
+    parser.add_argument("--atomic", type=Path, default=atomic_polygons_path,
+                        help="atomic polygons shapefile (default: ATOMIC_POLYGONS_PATH or project layout)")
+    parser.add_argument("--output-dir", type=Path, default=None,
+                        help="output directory (default: BLUEZONES_OUTPUT_DIR or output_csv/past)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per layer, capped at the CPU count; 1 with BZ_BACKEND=dask)")
+    args = parser.parse_args(argv)
+
+    # --- Outputs ---
+    if args.output_dir is not None:
+        output_directory = args.output_dir
+        output_directory.mkdir(parents=True, exist_ok=True)
+    else:
+        output_directory = output_dir("output_csv/past")
+    output_directory_shp = shapefile_subdir(output_directory)
+
+    # Build the atomic cache up front so workers only ever read it
+    atomic_path = atomic_cache(args.atomic, desired_crs)
+
+    # --- Intersect each layer in its own process ---
+    # The dask backend already spreads each layer's join over every core, so layers run one at a time
+    if os.getenv("BZ_BACKEND") == "dask":
+        default_workers = 1
+    else:
+        default_workers = min(len(shapefiles_past), os.cpu_count() or 1)
+    workers = args.workers or default_workers
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(process_layer, repeat(atomic_path), shapefiles_past, repeat(output_directory)))
+    new_field_names = {spec['flag_field']: name for spec, (name, _, _) in zip(shapefiles_past, results)}
+    dissolved_frames = {spec['flag_field']: frame for spec, (_, frame, _) in zip(shapefiles_past, results)}
+
+    # QA layers are written here, one transaction per layer, so workers never share the GeoPackage
+    for shapefile_past, (_, _, qa_layer) in zip(shapefiles_past, results):
+        if qa_layer is not None:
+            qa_layer.to_file(output_directory_shp / 'qa.gpkg', layer=f"{shapefile_past['flag_field']}_dissolved",
+                             driver='GPKG', engine='pyogrio')
+
+    # Join dissolved tables on unique_id
+    print(list(new_field_names.values()))
+
+    # Only unique_id and area are carried into the output; atomic geometry stays on disk
+    atomic_poly_csv = load_atomic(args.atomic, desired_crs, columns=['unique_id', 'area'])
+    final_df = build_final(dissolved_frames, new_field_names, atomic_poly_csv)
+
+    # Parquet is the primary output
+    final_output = output_directory / 'past_union.parquet'
+    final_df.to_parquet(final_output, engine='pyarrow', compression='zstd', index=False)
+    print(f"Final table saved: {final_output}")
+
+    if env_flag('BZ_WRITE_CSV'):
+        final_output_csv = output_directory / 'past_union.csv'
+        final_df.to_csv(final_output_csv, index=False)
+        print(f"Final CSV saved: {final_output_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,20 +4,26 @@ Blue Zone Analysis — PRESENT (intersections, merges, and spatial join)
 Purpose
 -------
 Load processed PRESENT layers (311 points, current moderate flood, 100-year flood), intersect with masked
-atomic polygons, aggregate by unique_id, and export dissolved CSVs and a final union CSV.
+atomic polygons, aggregate by unique_id, and export a final union table (Parquet; CSV optional).
 
 Path Configuration
 ------------------
 All paths are configurable via environment variables (see common_paths.py). Sensible project-relative
 defaults are provided so the script can run with a conventional layout.
 """
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 import pyproj
+import shapely
 
-from common_paths import path_from_env, output_dir, shapefile_subdir
+from common_paths import (path_from_env, output_dir, shapefile_subdir, env_flag, atomic_cache, read_atomic, load_atomic,
+                          read_layer, layer_bbox, subdivide, fast_intersection, overlap_pairs,
+                          concat_layer_tables, to_crs_if_needed)
 
 # --- Input paths ---
 atomic_polygons_path       = path_from_env("ATOMIC_POLYGONS_PATH",         "Mask/atomic_regular_State.shp")
@@ -25,104 +31,168 @@ present_311_path           = path_from_env("PRESENT_311_PATH",            "prese
 present_moderate_flood_path= path_from_env("PRESENT_MODERATE_FLOOD_PATH", "present/Moderate_current_Flood_poly.shp")
 present_100yr_path         = path_from_env("PRESENT_100YR_PATH",          "present/100yr.shp")
 
-# --- Outputs ---
-output_directory = output_dir("output_csv/present")
-output_directory_shp = shapefile_subdir(output_directory)
-
-# --- Load data ---
-atomic_polygons = gpd.read_file(atomic_polygons_path)
-present_311 = gpd.read_file(present_311_path)
-present_moderate_flood = gpd.read_file(present_moderate_flood_path)
-present_100yr = gpd.read_file(present_100yr_path)
-print('Present layers loaded')
-
 desired_crs = pyproj.CRS.from_epsg(2263)
-atomic_polygons = atomic_polygons.to_crs(desired_crs)
-atomic_polygons['area'] = atomic_polygons.geometry.area
-
-intersection_dict = {}
-new_field_names = []
-dissolved_csv_filenames = []
 
+# Only polygon layers get area-based intersections; the 311 points already carry unique_id
 shapefiles_present = [
-    {'gdf': present_311,             'flag_field': 'depcall'},
-    {'gdf': present_moderate_flood,  'flag_field': 'mod_cur'},
-    {'gdf': present_100yr,           'flag_field': '100yr'},
+    {'path': present_moderate_flood_path, 'flag_field': 'mod_cur', 'flood_type': 'mo_cu_fldC'},
+    {'path': present_100yr_path,          'flag_field': '100yr'},
 ]
-print('Present shapefile list created')
 
-# Only process polygon layers for area-based intersections (skip index 0 which is 311 points)
-for idx, shapefile_present in enumerate(shapefiles_present[1:], start=1):
-    gdf = shapefile_present['gdf'].to_crs(desired_crs)
-    intersection_result = gpd.overlay(atomic_polygons, gdf, how='intersection')
 
-    new_field_name = shapefile_present['flag_field'][:-2] + 'A'
-    new_field_names.append(new_field_name)
+def process_layer(atomic_path: Path, shapefile_present: dict, output_directory: Path):
+    """Intersect one present flood layer with the atomic polygons and aggregate by unique_id.
+
+    Runs in a worker process, so inputs are read from disk rather than pickled over.
+    Returns (area field name, dissolved table indexed by unique_id, QA layer or None).
+    """
+    # Carry only the columns the aggregation needs through the intersection
+    keep_fields = [shapefile_present['flag_field']]
+    if 'flood_type' in shapefile_present:
+        keep_fields.append(shapefile_present['flood_type'])
+    atomic_min = read_atomic(atomic_path, columns=['unique_id', 'area', 'geometry'])
+    # Prepared once, the atomic polygons answer every contains/intersects test below faster
+    shapely.prepare(atomic_min.geometry.values)
+    # Read only the kept columns, and only features near the atomic polygons
+    bbox = layer_bbox(shapefile_present['path'], atomic_min.total_bounds, desired_crs)
+    gdf = read_layer(shapefile_present['path'], columns=keep_fields, bbox=bbox)
+    gdf = to_crs_if_needed(gdf, desired_crs)
+    # Very detailed polygons (FEMA zones, marine waters, ...) are tiled so each intersection stays small
+    if len(gdf) and shapely.get_num_coordinates(gdf.geometry.values).max() > 1000:
+        gdf = subdivide(gdf)
 
-    intersection_result[new_field_name] = intersection_result['geometry'].area
+    new_field_name = shapefile_present['flag_field'][:-2] + 'A'
 
-    shp_filename = output_directory_shp / f"{shapefile_present['flag_field']}_notdissolved.shp"
-    intersection_result.to_file(shp_filename)
+    # Only the per-pair overlap area is needed, so aggregate it directly by unique_id
+    left_idx, right_idx, geoms, areas = overlap_pairs(atomic_min, gdf)
+    df = pd.DataFrame({'unique_id': atomic_min['unique_id'].values[left_idx], new_field_name: areas})
+    for field in keep_fields:
+        df[field] = gdf[field].values[right_idx]
+    dissolved_df = df.groupby('unique_id', sort=False, observed=True).agg(
+        {new_field_name: 'sum', **{field: 'first' for field in keep_fields}}
+    ).reset_index()
+
+    qa_layer = None
+    if env_flag('BZ_WRITE_QA'):
+        # Reuses the intersections computed above; rows line up with `areas`
+        intersection_result = fast_intersection(atomic_min, gdf, pairs=(left_idx, right_idx, geoms))
+        intersection_result[new_field_name] = areas
+        qa_layer = intersection_result
+
+    if env_flag('BZ_WRITE_QA_CSV'):
+        csv_filename = output_directory / f"{shapefile_present['flag_field']}_dissolved.csv"
+        dissolved_df.to_csv(csv_filename, index=False)
+        print(f"Exported {csv_filename.name}")
+    print(f"Processed {shapefile_present['flag_field']}")
+    return new_field_name, dissolved_df.set_index('unique_id'), qa_layer
+
+
+def build_final(dissolved_frames: dict, new_field_names: dict, atomic_poly_csv: pd.DataFrame) -> pd.DataFrame:
+    """Join the per-layer and 311 tables onto the atomic polygons and add the *fg and BZ_present flags."""
+    final_df, renames = concat_layer_tables(dissolved_frames)
+    # Area columns under their joined names; only names shared by two layers were prefixed
+    area_fields = [renames[layer].get(name, name) for layer, name in new_field_names.items()]
+
+    final_df = atomic_poly_csv.set_index('unique_id').join(
+        final_df, how='left', lsuffix='_x', rsuffix='_y'
+    ).reset_index()
+
+    # 311 threshold flag
+    if 'Point_Coun' in final_df.columns:
+        final_df['depcaAfg'] = (final_df['Point_Coun'].fillna(0).values >= 3).astype(np.int8)
+    else:
+        final_df['depcaAfg'] = np.zeros(len(final_df), dtype=np.int8)
+
+    # Area-based flags
+    # One 2-D comparison of every area column against its row threshold. float64 is kept
+    # so areas sitting right at 10% are not flipped by float32 rounding
+    layer_areas = final_df[area_fields].to_numpy(dtype=np.float64)
+    threshold = 0.10 * final_df['area'].to_numpy(dtype=np.float64)
+    flags = np.greater_equal(layer_areas, threshold[:, None], out=np.empty(layer_areas.shape, dtype=bool))
+    flag_df = pd.DataFrame(flags.astype(np.int8), columns=[n + 'fg' for n in area_fields], index=final_df.index)
+    final_df = pd.concat([final_df, flag_df], axis=1)
+
+    # Reduce the same boolean array rather than re-reading the flag columns
+    final_df['BZ_present'] = (flags.any(axis=1) | final_df['depcaAfg'].to_numpy().astype(bool)).astype(np.int8)
+    return final_df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Intersect PRESENT flood layers and 311 calls with the atomic polygons.")
+    parser.add_argument("--atomic", type=Path, default=atomic_polygons_path,
+                        help="atomic polygons shapefile (default: ATOMIC_POLYGONS_PATH or project layout)")
+    parser.add_argument("--output-dir", type=Path, default=None,
+                        help="output directory (default: BLUEZONES_OUTPUT_DIR or output_csv/present)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per layer, capped at the CPU count; 1 with BZ_BACKEND=dask)")
+    args = parser.parse_args(argv)
+
+    # --- Outputs ---
+    if args.output_dir is not None:
+        output_directory = args.output_dir
+        output_directory.mkdir(parents=True, exist_ok=True)
+    else:
+        output_directory = output_dir("output_csv/present")
+    output_directory_shp = shapefile_subdir(output_directory)
 
-    df = pd.DataFrame(intersection_result)
+    # Build the atomic cache up front so workers only ever read it
+    atomic_path = atomic_cache(args.atomic, desired_crs)
 
-    if idx == 1:
-        dissolved_df = df.groupby('unique_id').agg({
-            new_field_name: 'sum',
-            shapefile_present['flag_field']: 'first',
-            'mo_cu_fldC': 'first'
-        }).reset_index()
+    # --- Intersect each polygon layer in its own process ---
+    # The dask backend already spreads each layer's join over every core, so layers run one at a time
+    if os.getenv("BZ_BACKEND") == "dask":
+        default_workers = 1
     else:
-        dissolved_df = df.groupby('unique_id').agg({
-            new_field_name: 'sum',
-            shapefile_present['flag_field']: 'first',
-        }).reset_index()
-
-    csv_filename = output_directory / f"{shapefile_present['flag_field']}_dissolved.csv"
-    dissolved_df.to_csv(csv_filename, index=False)
-    dissolved_csv_filenames.append(csv_filename)
-    print(f"Exported {csv_filename.name}")
-
-# Dissolve 311 points by unique_id (no area calc needed)
-present_311_df = pd.DataFrame(present_311)
-# Keep only necessary columns if present
-keep_cols = [c for c in ['unique_id', 'depcall', 'Point_Coun'] if c in present_311_df.columns]
-present_311_csv = present_311_df[keep_cols].groupby('unique_id').agg({
-    'depcall': 'first' if 'depcall' in keep_cols else 'first',
-    'Point_Coun': 'first' if 'Point_Coun' in keep_cols else 'first',
-}).reset_index()
-
-# Merge dissolved CSVs + 311
-dataframes = [pd.read_csv(p) for p in dissolved_csv_filenames]
-dataframes.append(present_311_csv)
-
-final_df = dataframes[0]
-suffix_counter = 0
-for df in dataframes[1:]:
-    suffix_counter += 1
-    suffix = f"_{suffix_counter}"
-    final_df = final_df.merge(df, on='unique_id', how='outer', suffixes=(suffix, suffix))
-
-atomic_poly_csv = pd.DataFrame(atomic_polygons)
-final_df = atomic_poly_csv.merge(final_df, on='unique_id', how='left', suffixes=('_x', '_y'))
-
-# 311 threshold flag
-final_df['depcaAfg'] = 0
-if 'Point_Coun' in final_df.columns:
-    final_df.loc[final_df['Point_Coun'] >= 3, 'depcaAfg'] = 1
-
-# Area-based flags
-for n in new_field_names:
-    threshold = 0.10 * final_df['area']
-    new_flag = n + 'fg'
-    final_df[new_flag] = (final_df[n] >= threshold).astype(int)
-
-final_df['BZ_present'] = 0
-final_df.loc[
-    (final_df.get('depcaAfg', 0) == 1) |
-    (final_df.get('mod_cAfg', 0) == 1) |
-    (final_df.get('100Afg',   0) == 1), 'BZ_present'] = 1
-
-final_output_csv = output_directory / 'present_union.csv'
-final_df.to_csv(final_output_csv, index=False, header=True)
-print(f"Final CSV saved: {final_output_csv}")
+        default_workers = min(len(shapefiles_present), os.cpu_count() or 1)
+    workers = args.workers or default_workers
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(process_layer, repeat(atomic_path), shapefiles_present, repeat(output_directory)))
+    new_field_names = {spec['flag_field']: name for spec, (name, _, _) in zip(shapefiles_present, results)}
+    dissolved_frames = {spec['flag_field']: frame for spec, (_, frame, _) in zip(shapefiles_present, results)}
+
+    # QA layers are written here, one transaction per layer, so workers never share the GeoPackage
+    for shapefile_present, (_, _, qa_layer) in zip(shapefiles_present, results):
+        if qa_layer is not None:
+            qa_layer.to_file(output_directory_shp / 'qa.gpkg', layer=f"{shapefile_present['flag_field']}_notdissolved",
+                             driver='GPKG', engine='pyogrio')
+
+    # The 311 points already carry unique_id, so their geometry is never decoded
+    present_311 = read_layer(present_311_path, columns=['unique_id', 'depcall', 'Point_Coun'], read_geometry=False)
+    # Only unique_id and area are carried into the output; atomic geometry stays on disk
+    atomic_poly_csv = load_atomic(args.atomic, desired_crs, columns=['unique_id', 'area'])
+
+    # Dissolve 311 points by unique_id (no area calc needed)
+    present_311_df = pd.DataFrame(present_311)
+    # Keep only necessary columns if present
+    keep_cols = [c for c in ['unique_id', 'depcall', 'Point_Coun'] if c in present_311_df.columns]
+    # Share the atomic categories; ids outside the atomic polygons would be dropped by the join anyway
+    atomic_ids = atomic_poly_csv['unique_id'].cat.categories
+    if pd.api.types.is_numeric_dtype(present_311_df['unique_id']) != pd.api.types.is_numeric_dtype(atomic_ids):
+        raise ValueError(
+            f"311 unique_id ({present_311_df['unique_id'].dtype}) and atomic polygon unique_id "
+            f"({atomic_ids.dtype}) have incompatible dtypes"
+        )
+    present_311_df = present_311_df[present_311_df['unique_id'].isin(atomic_ids)].copy()
+    present_311_df['unique_id'] = present_311_df['unique_id'].astype(pd.CategoricalDtype(atomic_ids))
+    present_311_csv = present_311_df[keep_cols].groupby('unique_id', sort=False, observed=True).agg({
+        'depcall': 'first' if 'depcall' in keep_cols else 'first',
+        'Point_Coun': 'first' if 'Point_Coun' in keep_cols else 'first',
+    }).reset_index()
+
+    # Join dissolved tables + 311 on unique_id
+    dissolved_frames['311'] = present_311_csv.set_index('unique_id')
+    final_df = build_final(dissolved_frames, new_field_names, atomic_poly_csv)
+
+    # Parquet is the primary output
+    final_output = output_directory / 'present_union.parquet'
+    final_df.to_parquet(final_output, engine='pyarrow', compression='zstd', index=False)
+    print(f"Final table saved: {final_output}")
+
+    if env_flag('BZ_WRITE_CSV'):
+        final_output_csv = output_directory / 'present_union.csv'
+        final_df.to_csv(final_output_csv, index=False, header=True)
+        print(f"Final CSV saved: {final_output_csv}")
+
+
+if __name__ == "__main__":
+    main()
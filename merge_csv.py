@@ -3,8 +3,9 @@ Blue Zone Analysis — MERGE (combine past/present/future union CSVs)
 
 Purpose
 -------
-Merge the three per-era union CSVs on `unique_id` and compute a consolidated `BZ` flag where
-all three (past, present, future) equal 1.
+Merge the three per-era union tables on `unique_id` and compute a consolidated `BZ` flag where
+all three (past, present, future) equal 1. Union tables may be Parquet (the default output of the
+id_bluebelts_* scripts) or CSV; the format is picked from the file suffix.
 
 Path Configuration
 ------------------
@@ -14,9 +15,9 @@ match the outputs generated by the other generalized scripts.
 Environment variables (optional)
 --------------------------------
   # Inputs (override as needed)
-  PAST_UNION_CSV      -> path to past_union.csv (default: output_csv/past/past_union.csv)
-  PRESENT_UNION_CSV   -> path to present_union.csv (default: output_csv/present/present_union.csv)
-  FUTURE_UNION_CSV    -> path to future_union.csv (default: output_csv/future/future_union.csv)
+  PAST_UNION_CSV      -> path to the past union table (default: output_csv/past/past_union.parquet)
+  PRESENT_UNION_CSV   -> path to the present union table (default: output_csv/present/present_union.parquet)
+  FUTURE_UNION_CSV    -> path to the future union table (default: output_csv/future/future_union.parquet)
 
   # Output (either specify file directly or override directory)
   MERGED_OUTPUT_CSV   -> final merged CSV path (default: <BLUEZONES_OUTPUT_DIR or ./output_csv>/merged/BZ_criteria_all.csv)
@@ -41,10 +42,17 @@ def _default_output_root() -> Path:
 def _path_from_env(env_var: str, relative_default: str) -> Path:
     return Path(os.getenv(env_var, str(_base_dir() / relative_default)))
 
+
+def _read_union(path: Path) -> pd.DataFrame:
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    # Use low_memory=False for wide CSVs
+    return pd.read_csv(path, low_memory=False)
+
 # ------------------------- configure inputs/outputs -------------------------
-PAST_UNION   = _path_from_env("PAST_UNION_CSV",    "output_csv/past/past_union.csv")
-PRESENT_UNION= _path_from_env("PRESENT_UNION_CSV", "output_csv/present/present_union.csv")
-FUTURE_UNION = _path_from_env("FUTURE_UNION_CSV",  "output_csv/future/future_union.csv")
+PAST_UNION   = _path_from_env("PAST_UNION_CSV",    "output_csv/past/past_union.parquet")
+PRESENT_UNION= _path_from_env("PRESENT_UNION_CSV", "output_csv/present/present_union.parquet")
+FUTURE_UNION = _path_from_env("FUTURE_UNION_CSV",  "output_csv/future/future_union.parquet")
 
 merged_out_env = os.getenv("MERGED_OUTPUT_CSV")
 if merged_out_env:
@@ -56,13 +64,13 @@ else:
     MERGED_OUT = MERGED_OUT_DIR / "BZ_criteria_all.csv"
 
 # ------------------------------ load inputs --------------------------------
-# Use low_memory=False for wide CSVs; coerce types after read for safety
+# Coerce types after read for safety
 cols_needed = ["unique_id", "BZ_past", "BZ_present", "BZ_future"]
 
-# Load each CSV (they may contain many more columns)
-df_past = pd.read_csv(PAST_UNION, low_memory=False)
-df_pres = pd.read_csv(PRESENT_UNION, low_memory=False)
-df_futr = pd.read_csv(FUTURE_UNION, low_memory=False)
+# Load each table (they may contain many more columns)
+df_past = _read_union(PAST_UNION)
+df_pres = _read_union(PRESENT_UNION)
+df_futr = _read_union(FUTURE_UNION)
 
 # Ensure unique_id is numeric but keep as int for merging consistency
 for d in (df_past, df_pres, df_futr):